@@ -1,23 +1,36 @@
-import re
+import copy
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 import numpy as np
 import pandas as pd
-from tqdm.notebook import tqdm
+from tqdm.auto import tqdm
 
 from renderapi.client import (tilePairClient, pointMatchClient, WithPool)
-from renderapi.stack import get_z_values_for_stack
+from renderapi.stack import get_section_z_value, get_stack_sectionData
 from renderapi.pointmatch import get_matches_within_group
 
 
 __all__ = ['get_tile_pairs_4_montage',
-           'generate_point_matches']
-        #    'get_matches_within_section'
+           'generate_point_matches',
+           'get_matches_within_section',
+           'get_matches_within_stack']
 
 
-def get_tile_pairs_4_montage(stack, render,
+# pyarrow is optional, used only to speed up tileId parsing
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Column and row are the last two integers of each tileId
+# (named groups and a plain string let pandas use Arrow's `extract_regex`)
+_TILE_ID_PATTERN = r'(?P<c>\d+)\D+(?P<r>\d+)\D*$'
+
+
+def get_tile_pairs_4_montage(stack, render, N_workers=8, N_sections=1,
                              **tilePairClient_kwargs):
-    """Collect tile pairs from stack one section at a time for montaging
+    """Collect tile pairs from stack in (concurrent) ranges of sections for montaging
 
     Parameters
     ----------
@@ -25,6 +38,14 @@ def get_tile_pairs_4_montage(stack, render,
         Stack from which to generate DataFrame
     render : `renderapi.render.RenderClient`
         `render-ws` instance
+    N_workers : scalar (optional)
+        Number of concurrent `tilePairClient` calls
+        Each call starts its own Java client, so up to `N_workers` JVMs run at once
+        `outjson` is only accepted if `N_workers=1`
+    N_sections : scalar (optional)
+        Number of consecutive sections to request per `tilePairClient` call
+        Values > 1 also return pairs across neighbouring sections unless
+        `zNeighborDistance=0` is passed (1 by default)
     tilePairClient_kwargs : dict
         Optional keyword arguments to pass to `tilePairClient`
         -----------
@@ -78,28 +99,52 @@ def get_tile_pairs_4_montage(stack, render,
     df_pairs : `pd.DataFrame`
         DataFrame of tile pairs from a given stack
     """
-    # Initialize tile pairs DataFrame
-    pairs_cols = ['stack', 'z']
-    df_pairs = pd.DataFrame(columns=pairs_cols)
-
-    # Iterate through stack's z values
-    z_values = get_z_values_for_stack(stack=stack,
-                                      render=render)
-    for z in z_values:
-        # Generate tile pairs
-        tile_pairs_json = tilePairClient(stack=stack,
-                                         minz=z,
-                                         maxz=z,
-                                         render=render,
-                                         **tilePairClient_kwargs)
-        # Create DataFrame from json
-        df = pd.json_normalize(tile_pairs_json['neighborPairs'])
-        df['z'] = z
-        df_pairs = df_pairs.append(df, sort=False)
-
-    # Add stack info and reset index
+    # Concurrent calls would all write to (and delete) the same json file
+    if N_workers > 1 and tilePairClient_kwargs.get('outjson') is not None:
+        raise ValueError("`outjson` requires `N_workers=1`.")
+
+    # Get sectionId and z value of every section in a single request
+    section_data = get_stack_sectionData(stack=stack,
+                                         render=render)
+    z_map = {d['sectionId']: d['z'] for d in section_data}
+    z_values = sorted(set(z_map.values()))
+
+    # Generate tile pairs for consecutive ranges of z values in parallel
+    # (each call runs a Java client subprocess, threads just wait on it)
+    z_ranges = [z_values[i:i + N_sections] for i in range(0, len(z_values), N_sections)]
+    get_tile_pairs_partial = partial(get_tile_pairs_within_z_range,
+                                     stack=stack,
+                                     render=render,
+                                     **tilePairClient_kwargs)
+    with ThreadPoolExecutor(max_workers=N_workers) as executor:
+        neighbor_pairs = list(executor.map(get_tile_pairs_partial, z_ranges))
+
+    # Flatten tile pairs from every section into columns
+    # and create DataFrame in one go
+    pairs = [pair for range_pairs in neighbor_pairs for pair in range_pairs]
+    data = {f'{tile}.{key}': [pair[tile].get(key) for pair in pairs]
+            for tile in ['p', 'q'] for key in ['groupId', 'id', 'relativePosition']}
+    df_pairs = pd.DataFrame(data)
+    # Tile 'p' is always from the requested range, so its section sets z
+    unknown = set(df_pairs['p.groupId']) - set(z_map)
+    if unknown:
+        raise ValueError(f"Tile pairs from sections not found in {stack}: "
+                         f"{sorted(unknown)}")
+    df_pairs['z'] = df_pairs['p.groupId'].map(z_map).astype(np.float64)
+
+    # Add stack info
     df_pairs['stack'] = stack
-    return df_pairs.reset_index(drop=True)
+    return df_pairs
+
+
+def get_tile_pairs_within_z_range(z_range, stack, render, **tilePairClient_kwargs):
+    """Tile pair client wrapper for use in multithreading"""
+    tile_pairs_json = tilePairClient(stack=stack,
+                                     minz=z_range[0],
+                                     maxz=z_range[-1],
+                                     render=render,
+                                     **tilePairClient_kwargs)
+    return tile_pairs_json['neighborPairs']
 
 
 def run_point_match_client(data, stack, collection, render, **pointMatchClient_kwargs):
@@ -185,73 +230,189 @@ def generate_point_matches(df_pairs, match_collections, sift_options, render,
             If specified, option to select which channel is used for stack2, if specified.
             (default=None)
     """
-    # Loop through sections of each montage stack
-    for (stack, z), tile_pairs in tqdm(df_pairs.groupby(['stack', 'z'])):
+    # Set up `pointMatchClient` partial for each montage stack
+    point_match_client_partials = {}
+    for stack in df_pairs['stack'].unique():
+        point_match_client_partials[stack] = partial(run_point_match_client,
+                                                     stack=stack,
+                                                     collection=match_collections[stack],
+                                                     render=render,
+                                                     **pointMatchClient_kwargs)
+
+    # Group tile pairs into batches within each section of each montage stack
+    batch_ids = df_pairs.groupby(['stack', 'z'], sort=False).cumcount() // batch_size
+    batches = df_pairs.groupby(['stack', 'z', batch_ids], sort=False)
 
-        # Group tile pairs into batches
-        grouping = np.arange(len(tile_pairs)) // batch_size
-        for i, batch in tqdm(tile_pairs.groupby(grouping), leave=False):
+    # Keep a single pool of `N_cores` workers alive for the whole run
+    with WithPool(N_cores) as pool:
 
-            # Set up `pointMatchClient` partial
-            point_match_client_partial = partial(run_point_match_client,
-                                                 stack=stack,
-                                                 collection=match_collections[stack],
-                                                 render=render,
-                                                 **pointMatchClient_kwargs)
+        # Loop through batches
+        for (stack, z, i), batch in tqdm(batches, total=batches.ngroups,
+                                         mininterval=1.0):
 
             # Create batch of tile pairs
-            tp_batch = [[tuple(tp)] for tp in batch[['p.id', 'q.id']].values.tolist()]
+            p_ids = batch['p.id'].to_numpy()
+            q_ids = batch['q.id'].to_numpy()
+            tp_batch = [[(p, q)] for p, q in zip(p_ids, q_ids)]
             # Create corresponding batch of SIFT options (updating `firstCanvasPosition` arg)
-            sift_options_batch = []
-            for i in batch.index:
-                sift_options.firstCanvasPosition = batch.loc[i, 'p.relativePosition']
-                sift_options_batch.append(sift_options)
+            # (shallow copies so each tile pair keeps its own position)
+            positions = batch['p.relativePosition'].to_numpy()
+            sift_options_batch = [copy.copy(sift_options) for _ in positions]
+            for so, position in zip(sift_options_batch, positions):
+                so.firstCanvasPosition = position
 
-            # Run `pointMatchClient` on `N_cores`
-            with WithPool(N_cores) as pool:
-                pool.map(point_match_client_partial, zip(tp_batch, sift_options_batch))
+            # Run `pointMatchClient` in parallel
+            # (stream results so one slow tile pair doesn't stall the rest)
+            for _ in pool.imap_unordered(point_match_client_partials[stack],
+                                         zip(tp_batch, sift_options_batch),
+                                         chunksize=1):
+                pass
 
 
 def remove_island_tiles():
     pass
 
 
-# TODO: make this function work
-# def get_matches_within_section(match_collection, sectionId, render):
-#     """Create DataFrame of point matches for a given section
-
-#     Parameters
-#     ----------
-#     match_collection : str
-#         Name of match collection
-#     sectionId : str
-#         Name of section
-#         Aka `groupId` in `renderapi` terminology
-#     render : `renderapi.render.RenderClient`
-#         `render-ws` instance
-
-#     Returns
-#     -------
-#     df_matches : `pd.DataFrame`
-#         DataFrame of point matches from a given section
-#     """
-#     # Initialize point matches DataFrame
-#     matches_cols = ['pc', 'pr', 'qc', 'qr', 'N_matches']
-#     df_matches = pd.DataFrame(columns=matches_cols)
-
-#     # Get point match data as json via `renderapi`
-#     matches_json = get_matches_within_group(matchCollection=match_collection,
-#                                             groupId=sectionId,
-#                                             render=render)
-#     # Create DataFrame from json and concatenate with point matches DataFrame
-#     df_matches = pd.concat([df_matches, json_normalize(matches_json)],
-#                            axis=1, sort=False)
-
-#     # Populate DataFrame with row, column and number of matches data
-#     df_matches[['pc', 'pr']] = np.stack(df_matches['pId'].apply(lambda x:\
-#                                    [int(i) for i in re.findall(r'\d+', x)[-2:]]))
-#     df_matches[['qc', 'qr']] = np.stack(df_matches['qId'].apply(lambda x:\
-#                                    [int(i) for i in re.findall(r'\d+', x)[-2:]]))
-#     df_matches['N_matches'] = df_matches['matches.p'].apply(lambda x:\
-#                                   np.array(x).shape[1])
-#     return df_matches
+def get_match_records_within_section(sectionId, stack, match_collection, render, z=None):
+    """Collect point match records for a given section
+
+    Parameters
+    ----------
+    sectionId : str
+        Name of section
+        Aka `groupId` in `renderapi` terminology
+    stack : str
+        Stack to which the section belongs
+    match_collection : str
+        Name of match collection
+    render : `renderapi.render.RenderClient`
+        `render-ws` instance
+    z : scalar (optional)
+        z value of the section, looked up from `render-ws` if not provided
+
+    Returns
+    -------
+    matches_json : list
+        Point match records (dicts) from a given section
+        with `sectionId` and `z` added to each record
+    """
+    # Get point match data as json via `renderapi`
+    matches_json = get_matches_within_group(matchCollection=match_collection,
+                                            groupId=sectionId,
+                                            render=render)
+    if z is None:
+        z = get_section_z_value(stack=stack,
+                                sectionId=sectionId,
+                                render=render)
+    # Add section info to each record
+    for match in matches_json:
+        match['sectionId'] = sectionId
+        match['z'] = z
+    return matches_json
+
+
+def create_matches_DataFrame(matches_json, stack):
+    """Create DataFrame of point matches from point match records
+
+    Parameters
+    ----------
+    matches_json : list
+        Point match records (dicts) with `sectionId` and `z` added
+    stack : str
+        Stack to which the matched tiles belong
+
+    Returns
+    -------
+    df_matches : `pd.DataFrame`
+        DataFrame of point matches with row, column and number of matches data
+    """
+    # Create DataFrame from json
+    # (matches are nested only one level deep, e.g. `matches.p`, `matches.w`)
+    if matches_json:
+        df_matches = pd.json_normalize(matches_json, max_level=1)
+    else:
+        df_matches = pd.DataFrame(columns=['pGroupId', 'pId', 'qGroupId', 'qId',
+                                           'matches.p', 'matches.q', 'matches.w',
+                                           'sectionId', 'z'])
+    df_matches['z'] = df_matches['z'].astype(np.float64)
+    df_matches['stack'] = stack
+
+    # Populate DataFrame with row, column and number of matches data
+    for tile in ['p', 'q']:
+        tile_ids = df_matches[f'{tile}Id']
+        if pa is not None:
+            tile_ids = tile_ids.astype(pd.ArrowDtype(pa.string()))
+        cr = tile_ids.str.extract(_TILE_ID_PATTERN).astype(np.int32)
+        df_matches[[f'{tile}c', f'{tile}r']] = cr.to_numpy(dtype=np.int32)
+    df_matches['N_matches'] = df_matches['matches.p'].apply(lambda x:\
+                                  np.array(x).shape[1]).astype(np.int64)
+    return df_matches
+
+
+def get_matches_within_section(sectionId, stack, match_collection, render, z=None):
+    """Create DataFrame of point matches for a given section
+
+    Parameters
+    ----------
+    sectionId : str
+        Name of section
+        Aka `groupId` in `renderapi` terminology
+    stack : str
+        Stack to which the section belongs
+    match_collection : str
+        Name of match collection
+    render : `renderapi.render.RenderClient`
+        `render-ws` instance
+    z : scalar (optional)
+        z value of the section, looked up from `render-ws` if not provided
+
+    Returns
+    -------
+    df_matches : `pd.DataFrame`
+        DataFrame of point matches from a given section
+    """
+    matches_json = get_match_records_within_section(sectionId=sectionId,
+                                                    stack=stack,
+                                                    match_collection=match_collection,
+                                                    render=render,
+                                                    z=z)
+    return create_matches_DataFrame(matches_json, stack=stack)
+
+
+def get_matches_within_stack(stack, match_collection, render, N_workers=8):
+    """Create DataFrame of point matches for every section in a stack
+
+    Parameters
+    ----------
+    stack : str
+        Stack from which to collect point matches
+    match_collection : str
+        Name of match collection
+    render : `renderapi.render.RenderClient`
+        `render-ws` instance
+    N_workers : scalar (optional)
+        Number of threads with which to request sections from `render-ws`
+
+    Returns
+    -------
+    df_matches : `pd.DataFrame`
+        DataFrame of point matches from a given stack
+    """
+    # Get sectionId and z value of every section in a single request
+    section_data = get_stack_sectionData(stack=stack,
+                                         render=render)
+
+    # Fetch point match records for each section in parallel (I/O bound)
+    get_records_partial = partial(get_match_records_within_section,
+                                  stack=stack,
+                                  match_collection=match_collection,
+                                  render=render)
+    with ThreadPoolExecutor(max_workers=N_workers) as executor:
+        records = [match for matches_json in
+                   executor.map(lambda d: get_records_partial(d['sectionId'],
+                                                              z=d['z']),
+                                section_data)
+                   for match in matches_json]
+
+    # Create DataFrame from all records in one go
+    return create_matches_DataFrame(records, stack=stack)
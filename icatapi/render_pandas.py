@@ -76,13 +76,14 @@ def create_stacks_DataFrame(stacks, render):
     df_stacks : `pd.DataFrame`
         DataFrame of all `TileSpec`s from given stacks
     """
-    # Initialize DataFrame
-    df_stacks = pd.DataFrame()
-    # Create and append DataFrames from each given stack
-    for stack in stacks:
-        df_stack = create_stack_DataFrame(stack, render=render)
-        df_stacks = df_stacks.append(df_stack, sort=False)
-    return df_stacks.reset_index(drop=True)
+    # Create DataFrames from each given stack
+    frames = [create_stack_DataFrame(stack, render=render) for stack in stacks]
+    # Concatenate in one go (skipping the copy when there is nothing to join)
+    if not frames:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True, sort=False)
 
 
 def create_project_DataFrame(render):
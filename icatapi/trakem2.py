@@ -11,6 +11,9 @@ from renderapi.client import import_tilespecs
 from renderapi.transform import AffineModel
 
 
+_DIGITS_RE = re.compile(r'\d+')
+
+
 def get_random_ints(N):
     """Generate a random integer with cardinality N"""
     lower = 10**(N-1)
@@ -23,7 +26,7 @@ def create_patch_xml(tile_spec):
     # Abbreviate tile specification
     ts = tile_spec
     # Generate oid
-    x, y = [int(i) for i in re.findall(r'\d+', ts.tileId)[-2:]]
+    x, y = [int(i) for i in _DIGITS_RE.findall(ts.tileId)[-2:]]
     oid = f"{ts.z:.0f}{x:02d}{y:02d}"
     # Get total transform
     AT = AffineModel()